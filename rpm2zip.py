@@ -12,90 +12,470 @@
 # WARRANTY OF DESIGN, MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE.
 #
 
-import os, argparse, subprocess, re, tempfile, shutil
+import sys, os, argparse, subprocess, tempfile, shutil, concurrent.futures, multiprocessing, multiprocessing.pool, stat, time, zipfile
+
+# Use RPM Python bindings if available to read RPM headers and the rpmdb
+# in-process instead of running RPM_EXE.
+try:
+  import rpm
+except ImportError:
+  rpm = None
 
 
 RPM_EXE = 'rpm.exe'
 RPM2CPIO_EXE = 'rpm2cpio.exe'
-CPIO_EXE = 'cpio.exe'
+
+RPMLIB_PREFIX = 'rpmlib('
+
+# Maximum number of names passed to a single rpm call (keeps the command line
+# within the system limits).
+RPM_ARGS_MAX = 200
+
+CPIO_MAGIC = (b'070701', b'070702')
+CPIO_TRAILER = b'TRAILER!!!'
 
 ARCHIVE_TYPE = '7z'
 ARCHIVE_CMD = ['7z.exe', 'a', '-r', '%{out}', '*']
 
+# Note: with a 7z build having the zstd codec (e.g. 7-Zip ZS), zstd is several
+# times faster than the default LZMA2 both ways at a comparable ratio, but the
+# resulting archives can only be unpacked by such a build as well.
+#ARCHIVE_CMD = ['7z.exe', 'a', '-r', '-m0=zstd', '-mx=3', '%{out}', '*']
+
+# Note: zip archives are created in-process (no ARCHIVE_CMD) by streaming the
+# RPM payload straight into the archive, without unpacking it to disk first.
 #ARCHIVE_TYPE = 'zip'
-#ARCHIVE_CMD = ['zip.exe', '-mry9', '%{out}', '.']
+#ARCHIVE_CMD = None
 
 
-def repack_one_file (file):
+#
+# Reads a cpio archive in the `newc` format (as produced by rpm2cpio) from
+# stream and yields a tuple (name, mode, mtime, data) for each archive member.
+# Names are relative (with the leading `./` or `/` removed). Hard links are
+# yielded as separate members sharing the same data.
+#
+
+def read_cpio (stream):
+
+  links = {}
+
+  while True:
+
+    hdr = stream.read (110)
+    if len (hdr) != 110 or hdr [:6] not in CPIO_MAGIC:
+      raise IOError ('Invalid cpio header')
+
+    ino, mode, _, _, nlink, mtime, size, _, _, _, _, namesize, _ = \
+      [int (hdr [i:i + 8], 16) for i in range (6, 110, 8)]
+
+    # Note: both the name (following the header) and the data are padded to
+    # a multiple of 4 bytes.
+    name = stream.read (namesize) [:-1]
+    stream.read (-(110 + namesize) % 4)
+    if name == CPIO_TRAILER:
+      break
+
+    data = stream.read (size)
+    stream.read (-size % 4)
+
+    name = os.path.normpath (os.fsdecode (name)).lstrip ('/')
+    if name == '.':
+      continue
+
+    if nlink > 1 and not stat.S_ISDIR (mode):
+      # Hard links carry data only in the last entry of the link set.
+      members = links.setdefault (ino, [])
+      members.append ((name, mode, mtime))
+      if data:
+        for name, mode, mtime in links.pop (ino):
+          yield name, mode, mtime, data
+    else:
+      yield name, mode, mtime, data
+
+  for members in links.values ():
+    for name, mode, mtime in members:
+      yield name, mode, mtime, b''
+
+
+#
+# Extracts a cpio archive read from stream to dest_dir creating directories
+# and preserving modification times (same as `cpio -idm`).
+#
+
+def extract_cpio (stream, dest_dir):
+
+  dirs = []
+  # Note: remember directories known to exist to check each one only once.
+  known_dirs = set ()
+
+  for name, mode, mtime, data in read_cpio (stream):
+
+    # Note: don't let a malformed archive write outside dest_dir.
+    if name == os.pardir or name.startswith (os.pardir + os.sep):
+      raise IOError ('Invalid cpio member name `%s`' % name)
+
+    path = os.path.join (dest_dir, name)
+
+    if stat.S_ISDIR (mode):
+      if path not in known_dirs:
+        os.makedirs (path, exist_ok = True)
+        known_dirs.add (path)
+      # Set directory times last as creating children changes them.
+      dirs.append ((path, mode, mtime))
+      continue
+
+    parent = os.path.dirname (path)
+    if parent not in known_dirs:
+      os.makedirs (parent, exist_ok = True)
+      known_dirs.add (parent)
+
+    if stat.S_ISLNK (mode):
+      os.symlink (os.fsdecode (data), path)
+      continue
+
+    if not stat.S_ISREG (mode):
+      # Note: FIFOs and device nodes can't be recreated portably (and don't
+      # belong in an archive anyway).
+      print ('WARNING: Skipping special file `%s`.' % name)
+      continue
+
+    with open (path, 'wb') as f:
+      f.write (data)
+    os.chmod (path, stat.S_IMODE (mode))
+    os.utime (path, (mtime, mtime))
+
+  for path, mode, mtime in reversed (dirs):
+    os.chmod (path, stat.S_IMODE (mode))
+    os.utime (path, (mtime, mtime))
+
+
+#
+# Stores a cpio archive read from stream in a new zip archive out_file, along
+# with RPM_REQUIREMENTS containing the list returned by get_reqs (called once
+# all members are stored). Members go straight from the stream to the archive
+# (same as `zip -ry9` of the `cpio -idm` result).
+#
+
+def zip_cpio (stream, out_file, get_reqs):
+
+  with zipfile.ZipFile (out_file, 'w', zipfile.ZIP_DEFLATED) as zf:
+
+    for name, mode, mtime, data in read_cpio (stream):
+
+      if stat.S_ISDIR (mode):
+        name += '/'
+
+      # Note: zip can't store dates before 1980.
+      info = zipfile.ZipInfo (name, max (time.localtime (mtime) [:6], (1980, 1, 1, 0, 0, 0)))
+      info.create_system = 3
+      info.external_attr = mode << 16
+      info.compress_type = zipfile.ZIP_STORED if stat.S_ISDIR (mode) else zipfile.ZIP_DEFLATED
+      # Note: ZipFile doesn't apply its compresslevel to a given ZipInfo.
+      zf.writestr (info, data, compresslevel = 9)
+
+    info = zipfile.ZipInfo ('RPM_REQUIREMENTS', time.localtime () [:6])
+    info.create_system = 3
+    info.external_attr = (stat.S_IFREG | 0o644) << 16
+    info.compress_type = zipfile.ZIP_DEFLATED
+    zf.writestr (info, '\n'.join (get_reqs ()), compresslevel = 9)
+
+
+#
+# Runs rpm2cpio on file and passes its output stream to func followed by args.
+#
+
+def rpm2cpio (file, func, *args):
+
+  proc = subprocess.Popen ([RPM2CPIO_EXE, file], stdout = subprocess.PIPE)
+  try:
+    func (proc.stdout, *args)
+    # Let rpm2cpio write whatever padding follows the trailer.
+    proc.stdout.read ()
+  except IOError:
+    # A broken stream is most likely due to rpm2cpio failure, report it.
+    proc.stdout.close ()
+    if not proc.wait ():
+      raise
+  finally:
+    proc.stdout.close ()
+    rc = proc.wait ()
+
+  if rc:
+    raise subprocess.CalledProcessError (rc, RPM2CPIO_EXE)
+
+
+#
+# Runs an rpm query with the given arguments on the given list of names and
+# yields output lines (without line ends) as they arrive. Names are passed to
+# rpm in chunks of RPM_ARGS_MAX. If check is False, a non-zero rpm exit code
+# (e.g. when some names are not found) is ignored.
+#
+
+def rpm_query (args, names, check = True):
+
+  for i in range (0, len (names), RPM_ARGS_MAX):
+    cmd = [ RPM_EXE, '-q' ] + args + names [i:i + RPM_ARGS_MAX]
+    with subprocess.Popen (cmd, stdout = subprocess.PIPE, text = True) as proc:
+      for line in proc.stdout:
+        yield line.rstrip ('\n')
+    if proc.returncode and check:
+      raise subprocess.CalledProcessError (proc.returncode, cmd)
+
+
+#
+# Queries requirements of all given RPM files with as few rpm calls as possible
+# (or in-process with RPM bindings) and returns a dict mapping each file to a
+# set of its requirement names (the same name is often required many times
+# with different version constraints).
+#
+
+def query_requires (files):
+
+  file_reqs = dict ()
+
+  if rpm:
 
-  print 'Processing `%s`...' % file
+    # Note: only headers are needed, skip signature and digest checks that
+    # would read the whole payload.
+    ts = rpm.TransactionSet ()
+    ts.setVSFlags (rpm._RPMVSF_NOSIGNATURES | rpm._RPMVSF_NODIGESTS)
+
+    for file in files:
+      with open (file, 'rb') as f:
+        hdr = ts.hdrFromFdno (f.fileno ())
+      file_reqs [file] = {os.fsdecode (r) for r in hdr [rpm.RPMTAG_REQUIRENAME]}
 
-  out_file = os.path.splitext (file)
-  if out_file [1] == '.rpm':
-    out_file = out_file [0] + '.' + ARCHIVE_TYPE
   else:
-    out_file = ''.join (out_file) + '.' + ARCHIVE_TYPE
 
-  if os.path.isfile (out_file):
-    print 'ERROR: `%s` already exists.' % out_file
-    return False
+    reqs = None
+    files_left = iter (files)
+
+    # Note: the query format makes rpm output bare requirement names (without
+    # version constraints) so that they may be passed to --whatprovides as is.
+    # Each file's list starts with a `@` line (rpm outputs files in order).
+    for r in rpm_query ([ '--qf', '@\\n[%{REQUIRENAME}\\n]', '-p' ], files):
+      if r == '@':
+        reqs = file_reqs [next (files_left)] = set ()
+      elif r:
+        reqs.add (r)
+
+  return { file: {r for r in reqs if r != '/@unixroot/usr/bin/sh' and not r.startswith (RPMLIB_PREFIX)}
+           for file, reqs in file_reqs.items () }
+
+
+#
+# Resolves the given set of requirement names to providing packages with as
+# few rpm calls as possible (or in-process with RPM bindings) and returns a dict
+# mapping each requirement to a set of package names.
+#
+
+def query_providers (reqs):
 
-  print 'Generating requirements...'
+  providers = dict ()
 
-  reqs = []
+  if rpm:
 
-  for r in filter (lambda r: r and r != '/@unixroot/usr/bin/sh', subprocess.check_output ([ RPM_EXE, '-q', '--requires', '-p', file ]).split ('\n')):
-    s = r.split () [0]
-    if not re.match (r'rpmlib\(.+\)', s):
-      reqs.append (s)
+    ts = rpm.TransactionSet ()
 
-  if  len (reqs):
-    reqs = list (set (filter (None, subprocess.check_output ([ RPM_EXE, '-q', '--whatprovides' ] + reqs).split ('\n'))))
-    reqs.sort ()
+    for r in reqs:
+      # Note: like --whatprovides, look up files in the file list as well.
+      hdrs = list (ts.dbMatch (rpm.RPMTAG_PROVIDENAME, r))
+      if not hdrs and r.startswith ('/'):
+        hdrs = list (ts.dbMatch (rpm.RPMTAG_BASENAMES, r))
+      if not hdrs:
+        raise LookupError ('no package provides %s' % r)
+      providers [r] = set (os.fsdecode (h [rpm.RPMTAG_NVRA]) for h in hdrs)
+
+  elif len (reqs):
+
+    # Note: --whatprovides doesn't tell which requirement each package was
+    # found for, so ask for all capabilities of found packages instead and
+    # match them against the requirements. Requirements provided some other
+    # way (e.g. files) or not provided at all are then looked up one by one.
+    for r in rpm_query ([ '--qf', '[%{=NVRA}\\t%{PROVIDENAME}\\n]', '--whatprovides' ], list (reqs), check = False):
+      pkg, _, name = r.partition ('\t')
+      if name in reqs:
+        providers.setdefault (name, set ()).add (pkg)
+
+    for r in sorted (reqs - providers.keys ()):
+      try:
+        providers [r] = set (filter (None, rpm_query ([ '--qf', '%{NVRA}\\n', '--whatprovides' ], [r])))
+      except subprocess.CalledProcessError:
+        raise LookupError ('no package provides %s' % r)
+
+  return providers
+
+
+#
+# Returns a dict mapping each of the given RPM files to a sorted list of
+# packages providing its requirements.
+#
+
+def resolve_requires (files):
+
+  print ('Generating requirements...')
+
+  # Note: requirements of all files are resolved at once because they usually
+  # overlap a lot and each rpm call has to load the rpmdb.
+  file_reqs = query_requires (files)
+  providers = query_providers (set ().union (*file_reqs.values ()))
+
+  return { file: sorted ({p for r in reqs for p in providers [r]})
+           for file, reqs in file_reqs.items () }
+
+
+#
+# Returns the absolute name of the archive the given RPM file is repacked to.
+#
+
+def get_out_file (file):
+
+  # Note: the archiver runs in a temporary directory, hence the absolute path.
+  out_file = os.path.abspath (file)
+  if out_file.endswith ('.rpm'):
+    out_file = out_file [:-4]
+  return out_file + '.' + ARCHIVE_TYPE
+
+
+#
+# Repacks the given RPM file to an archive next to it.
+#
+
+def repack_one_file (file):
 
-  cwd = None
-  tmpdir = None
+  print ('Processing `%s`...' % file)
 
+  out_file = get_out_file (file)
+
+  # Reserve the output name atomically so that duplicate inputs repacked in
+  # parallel don't clobber each other. The archive itself is written to a
+  # temporary name first and moved over the reservation once complete.
   try:
+    open (out_file, 'xb').close ()
+  except FileExistsError:
+    print ('ERROR: `%s` already exists.' % out_file)
+    return False
 
-    print 'Unpacking...'
+  # Note: keep the archive extension last, the archiver may depend on it.
+  tmp_file = '%s.tmp%s' % os.path.splitext (out_file)
+  if os.path.lexists (tmp_file):
+    os.remove (tmp_file)
 
-    tmpdir = tempfile.mkdtemp ()
+  try:
 
-    cwd = os.getcwd ()
-    os.chdir (tmpdir)
+    if not ARCHIVE_CMD:
 
-    subprocess.check_call ('%s %s | %s -idm' % (RPM2CPIO_EXE, file, CPIO_EXE), shell = True)
+      print ('Packing to `%s`...' % out_file)
 
-    with open ('RPM_REQUIREMENTS', 'w') as f:
-      f.write ('\n'.join (reqs))
+      rpm2cpio (file, zip_cpio, tmp_file, lambda: g_reqs.result () [file])
 
-    print 'Packing to `%s`...' % out_file
+    else:
 
-    cmd = [w.replace ('%{out}', out_file) for w in ARCHIVE_CMD]
-    subprocess.check_call (cmd)
+      repack_with_archiver (file, out_file, tmp_file)
 
-  except subprocess.CalledProcessError as e:
+    os.replace (tmp_file, out_file)
 
-    print e.output
+  except:
+    for f in (tmp_file, out_file):
+      if os.path.lexists (f):
+        os.remove (f)
     raise
 
-  finally:
+  return True
 
-    if cwd:
-      os.chdir (cwd)
 
-    if tmpdir:
-      shutil.rmtree (tmpdir)
+#
+# Deletes the given directory tree. Entries that can't be deleted because of
+# read-only modes restored from the payload are made writable and retried.
+# Anything that still fails is reported with a warning rather than raised as
+# this is meant to run in the background.
+#
 
-  return True
+def remove_tree (path):
+
+  def on_error (func, p, exc):
+    try:
+      # Note: a read-only parent keeps entries from being deleted on POSIX,
+      # a read-only entry itself on OS/2 and Windows.
+      for f in (os.path.dirname (p), p):
+        if not os.path.islink (f):
+          os.chmod (f, stat.S_IMODE (os.lstat (f).st_mode) | stat.S_IRWXU)
+      func (p)
+    except OSError as e:
+      print ('WARNING: Cannot delete `%s`: %s' % (p, e))
+
+  # Note: onerror is deprecated since Python 3.12 in favor of onexc (the only
+  # difference is the last handler argument which is not used here).
+  if sys.version_info >= (3, 12):
+    shutil.rmtree (path, onexc = on_error)
+  else:
+    shutil.rmtree (path, onerror = on_error)
+
+
+#
+# Unpacks the given RPM file to a temporary directory and packs it with
+# ARCHIVE_CMD to tmp_file which is later moved to out_file by the caller.
+#
+
+def repack_with_archiver (file, out_file, tmp_file):
+
+  print ('Unpacking...')
+
+  tmpdir = tempfile.mkdtemp ()
+
+  try:
+
+    rpm2cpio (file, extract_cpio, tmpdir)
+
+    reqs = g_reqs.result () [file]
+
+    with open (os.path.join (tmpdir, 'RPM_REQUIREMENTS'), 'wb') as f:
+      f.write ('\n'.join (reqs).encode ())
+
+    print ('Packing to `%s`...' % out_file)
+
+    # Note: the archiver's progress output is discarded as it would get mixed
+    # with other files being repacked in parallel (errors go to stderr).
+    cmd = [w.replace ('%{out}', tmp_file) for w in ARCHIVE_CMD]
+    subprocess.check_call (cmd, stdout = subprocess.DEVNULL, cwd = tmpdir)
+
+  finally:
+
+    # Deleting the unpacked tree may take a while, do it in the background
+    # while the next file is processed.
+    g_background.submit (remove_tree, tmpdir)
 
 # Main.
 
-g_cmdline = argparse.ArgumentParser (formatter_class = argparse.ArgumentDefaultsHelpFormatter)
-g_cmdline.add_argument ('FILE', nargs = '+', help = 'RPM file to repack')
-g_args = g_cmdline.parse_args ()
+if __name__ == '__main__':
+
+  g_cmdline = argparse.ArgumentParser (formatter_class = argparse.ArgumentDefaultsHelpFormatter)
+  g_cmdline.add_argument ('-j', '--jobs', type = int, default = multiprocessing.cpu_count (), help = 'number of files to repack in parallel')
+  g_cmdline.add_argument ('FILE', nargs = '+', help = 'RPM file to repack')
+  g_args = g_cmdline.parse_args ()
+
+  # Fail early rather than after other files are already repacked.
+  for file in g_args.FILE:
+    out_file = get_out_file (file)
+    if os.path.lexists (out_file):
+      print ('ERROR: `%s` already exists.' % out_file)
+      sys.exit (1)
 
-for file in g_args.FILE:
-  if not repack_one_file (file):
-    break
+  # Note: requirements are resolved in the background while payloads are
+  # being unpacked (it only needs RPM headers). The same thread deletes
+  # unpacked trees later on.
+  g_background = concurrent.futures.ThreadPoolExecutor (max_workers = 1)
+  g_reqs = g_background.submit (resolve_requires, g_args.FILE)
+
+  # Note: threads are enough here as the heavy lifting is done by external
+  # processes and by zlib and file I/O which all release the GIL.
+  pool = multiprocessing.pool.ThreadPool (processes = max (1, min (len (g_args.FILE), g_args.jobs)))
+
+  try:
+    for ok in pool.imap_unordered (repack_one_file, g_args.FILE):
+      if not ok:
+        break
+  finally:
+    pool.terminate ()
+    pool.join ()
+    g_background.shutdown ()
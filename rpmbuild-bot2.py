@@ -26,9 +26,20 @@ VER_FULL_REGEX = '\d+[.\d\w]*-\w+[.\w]*\.\w+'
 BUILD_USER_REGEX = '[a-zA-Z0-9_.-]+@[a-zA-Z0-9_.-]+'
 
 
-import sys, os, re, copy, argparse, configparser, subprocess, datetime, traceback, shutil, time, fnmatch, textwrap
+import sys, os, io, re, stat, copy, codecs, locale, functools, argparse, configparser, subprocess, datetime, time
 import getpass, socket # for user and hostname
 
+# Note: modules needed only by some commands or on rare paths (shutil, fnmatch,
+# textwrap, traceback) are imported where used to speed up startup.
+
+
+# Precompiled regular expressions used in hot paths.
+INTERP_RE = re.compile (r'\$\{(\w+:)?((?<=SHELL:).+|\w+)\}')
+VER_FULL_RE = re.compile (r'^%s$' % VER_FULL_REGEX)
+BUILD_USER_RE = re.compile (r'^%s$' % BUILD_USER_REGEX)
+WROTE_SRPM_RE = re.compile (r'^Wrote: +(.+\.src\.rpm)$', re.MULTILINE)
+SRPM_NAME_VER_RE = re.compile (r'^(.+)-(%s)\.src\.rpm$' % VER_FULL_REGEX)
+
 
 #
 # -----------------------------------------------------------------------------
@@ -46,6 +57,7 @@ import getpass, socket # for user and hostname
 # - Support for `${RPM:<NAME>}` interpolation that is replaced with the value of
 #   the <NAME> RPM macro.
 # - Support for copy.deepcopy.
+# - Caching of parsed INI files in #read.
 #
 # Note: We leave this class in even for Python 3 because of the extensions we
 # provide.
@@ -55,7 +67,9 @@ class Config (configparser.ConfigParser):
 
   def __init__ (self, rpm_macros, *args, **kwargs):
 
-    self.get_depth = 0
+    # Interpolated option values and options being interpolated.
+    self.get_cache = {}
+    self.get_stack = []
     self.rpm_macros = rpm_macros
     configparser.ConfigParser.__init__ (self, *args, **kwargs)
 
@@ -64,56 +78,148 @@ class Config (configparser.ConfigParser):
 
   def __deepcopy__ (self, memo):
 
-    copy = Config (self.rpm_macros, defaults = self.defaults ())
-    copy.rpm_macros = self.rpm_macros
-    for s in self.sections ():
-      copy.add_section (s)
-      for (n, v) in self.items (s):
-        copy.set (s, n, v)
-    return copy
+    new = Config (self.rpm_macros)
+    # Copy raw option dicts directly rather than going through set() for each
+    # option which is much slower (and also interpolates values). Note that raw
+    # values are immutable strings so copying the dicts is enough.
+    new._defaults = self._dict (self._defaults)
+    new._sections = self._dict ((s, self._dict (opts)) for s, opts in self._sections.items ())
+    for s in new._sections:
+      new._proxies [s] = configparser.SectionProxy (new, s)
+    return new
+
+  # Parsed INI files shared by all instances, see #read.
+  ini_cache = {}
+
+  # Output of `${SHELL:<COMMAND>}` commands shared by all instances (and hence
+  # by per-spec copies which start with an empty get_cache).
+  shell_cache = {}
+
+  # Same as ConfigParser.read but parses each file only once as long as it
+  # doesn't change (the same directory INI files are read for every spec).
+  def read (self, filenames, encoding = None):
+    if isinstance (filenames, (str, bytes, os.PathLike)):
+      filenames = [filenames]
+    read_ok = []
+    for path in filenames:
+      try:
+        st = os.stat (path)
+      except OSError:
+        continue
+      key = os.path.abspath (os.fsdecode (path))
+      stamp = (st.st_mtime_ns, st.st_size)
+      cached = Config.ini_cache.get (key)
+      if not cached or cached [0] != stamp:
+        ini = Config (self.rpm_macros)
+        with open (path, encoding = encoding) as f:
+          ini.read_file (f, os.fsdecode (path))
+        cached = Config.ini_cache [key] = (stamp, ini._defaults, ini._sections)
+      self.get_cache.clear ()
+      self._defaults.update (cached [1])
+      for s, opts in cached [2].items ():
+        if s not in self._sections:
+          self._sections [s] = self._dict ()
+          self._proxies [s] = configparser.SectionProxy (self, s)
+        self._sections [s].update (opts)
+      read_ok.append (path)
+    return read_ok
+
+  # Drop interpolated values whenever options change.
+
+  def _read (self, *args, **kwargs):
+    self.get_cache.clear ()
+    return super ()._read (*args, **kwargs)
+
+  def set (self, *args, **kwargs):
+    self.get_cache.clear ()
+    return super ().set (*args, **kwargs)
+
+  def remove_option (self, *args, **kwargs):
+    self.get_cache.clear ()
+    return super ().remove_option (*args, **kwargs)
+
+  def remove_section (self, *args, **kwargs):
+    self.get_cache.clear ()
+    return super ().remove_section (*args, **kwargs)
 
   def get (self, section, option = None, *, raw = False, vars = None, **kwargs):
 
     if not option:
       section, option = section.split (':')
 
+    # Note: options referenced by many others are interpolated only once.
+    key = (section, option)
+    cacheable = not raw and not vars and not kwargs
+    if cacheable and key in self.get_cache:
+      return self.get_cache [key]
+
     ret = super ().get (section, option, raw = True, vars = vars, **kwargs)
     if raw:
       return ret
 
-    for f_section, f_option in re.findall (r'\$\{(\w+:)?((?<=SHELL:).+|\w+)\}', ret):
-      self.get_depth = self.get_depth + 1
-      if self.get_depth < configparser.MAX_INTERPOLATION_DEPTH:
-        try:
-          if f_section == 'ENV:':
-            sub = os.environ.get (f_option)
-            if not sub: raise configparser.NoOptionError (f_option, f_section [:-1])
-          elif f_section == 'SHELL:':
-            sub = shell_output (f_option).strip ()
-          elif f_section == 'RPM:':
-            if f_option not in self.rpm_macros:
-              sub = command_output ([RPMBUILD_EXE, '--eval', '%%{?%s}' % f_option]).strip ()
-              self.rpm_macros [f_option] = sub
-            else:
-              sub = self.rpm_macros [f_option]
-          else:
-            sub = self.get (f_section [:-1] or section, f_option, vars = vars)
-          ret = ret.replace ('${{{0}{1}}}'.format (f_section, f_option), sub)
-        except RunError as e:
-          raise configparser.InterpolationError (section, option,
-            'Failed to interpolate ${%s%s}:\nThe following command failed with: %s:\n  %s' % (f_section, f_option, e.msg, e.cmd))
-      else:
-        raise configparser.InterpolationDepthError (option, section, ret)
+    if key in self.get_stack:
+      raise configparser.InterpolationError (option, section,
+        'Cyclic reference: %s' % ' -> '.join ('${%s:%s}' % k for k in self.get_stack [self.get_stack.index (key):] + [key]))
+    if len (self.get_stack) >= configparser.MAX_INTERPOLATION_DEPTH:
+      raise configparser.InterpolationDepthError (option, section, ret)
+
+    refs = INTERP_RE.findall (ret)
+
+    try:
+      # Note: rpmbuild can't evaluate macros from stdin so we can't keep it
+      # running. Instead, evaluate macros referenced by all options at once
+      # when some macro is missing to have as few rpmbuild calls as possible.
+      if any (s == 'RPM:' and o not in self.rpm_macros for s, o in refs):
+        eval_rpm_macros ([o for s, o in refs if s == 'RPM:'] + self.rpm_macro_refs (), self.rpm_macros)
+    except RunError as e:
+      raise configparser.InterpolationError (section, option,
+        'Failed to interpolate RPM macros:\nThe following command failed with: %s:\n  %s' % (e.msg, e.cmd))
 
-    self.get_depth = self.get_depth - 1
+    def interpolate (m):
+      f_section, f_option = m.group (1) or '', m.group (2)
+      try:
+        if f_section == 'ENV:':
+          sub = os.environ.get (f_option)
+          if not sub: raise configparser.NoOptionError (f_option, f_section [:-1])
+        elif f_section == 'SHELL:':
+          # Note: the command may depend on the spec's environment.
+          shell_key = (f_option, tuple (sorted ((g_run_env or os.environ).items ())))
+          sub = Config.shell_cache.get (shell_key)
+          if sub is None:
+            sub = Config.shell_cache [shell_key] = shell_output (f_option).strip ()
+        elif f_section == 'RPM:':
+          sub = self.rpm_macros [f_option]
+        else:
+          sub = self.get (f_section [:-1] or section, f_option, vars = vars)
+      except RunError as e:
+        raise configparser.InterpolationError (section, option,
+          'Failed to interpolate ${%s%s}:\nThe following command failed with: %s:\n  %s' % (f_section, f_option, e.msg, e.cmd))
+      return sub
+
+    # Note: substitute all references in a single pass over the value.
+    self.get_stack.append (key)
+    try:
+      ret = INTERP_RE.sub (interpolate, ret)
+    finally:
+      self.get_stack.pop ()
+
+    if cacheable:
+      self.get_cache [key] = ret
     return ret
 
+  def rpm_macro_refs (self):
+    values = list (self.defaults ().values ())
+    for s in self.sections ():
+      values += [v for n, v in self.items (s, raw = True)]
+    return [o for v in values for s, o in INTERP_RE.findall (v) if s == 'RPM:']
+
   def getlist (self, section, option = None, sep = None):
     return [v for v in self.get (section, option).split (sep) if v]
 
   def getlines (self, section, option = None): return self.getlist (section, option, '\n')
 
-  def getwords (self, section, option = None): return self.getlist (section, option, None)
+  # Note: split () with no separator never returns empty strings.
+  def getwords (self, section, option = None): return self.get (section, option).split ()
 
 
 #
@@ -180,12 +286,13 @@ def to_unixtimestr (unix_time):
 
 def log (msg, wrap_width = None, file_only = False):
 
-  if not wrap_width == None:
+  if wrap_width is not None:
+    import textwrap
     if int (wrap_width) <= 0:
       wrap_width = 79
     msg = textwrap.fill (msg, wrap_width)
 
-  if len (msg) == 0 or msg [-1] != '\n':
+  if not msg.endswith ('\n'):
     msg += '\n'
 
   if g_output_file:
@@ -222,9 +329,9 @@ def log_kind (kind, prefix, msg = None, **kwargs):
     msg = prefix
     prefix = None
 
-  while msg.startswith ('\n'):
-    kind = '\n' + kind
-    msg = msg [1:]
+  stripped = msg.lstrip ('\n')
+  kind = '\n' * (len (msg) - len (stripped)) + kind
+  msg = stripped
 
   log ('%s: ' % kind + (prefix and prefix + ': ' or '') + msg, **kwargs)
 
@@ -284,14 +391,11 @@ def log_input_warn (prompt, choice = None):
 
 def rotate_log (log_file):
 
-  if os.path.exists (log_file):
-
-    try: os.remove (log_file + '.bak')
-    except OSError: pass
-
-    try: os.rename (log_file, log_file + '.bak')
-    except OSError as e:
-      raise Error ('Cannot rename `%(log_file)s` to `.bak`: %(e)s' % locals ())
+  # Note: just try to replace the backup instead of checking first.
+  try: os.replace (log_file, log_file + '.bak')
+  except FileNotFoundError: pass
+  except OSError as e:
+    raise Error ('Cannot rename `%(log_file)s` to `.bak`: %(e)s' % locals ())
 
 #
 # -----------------------------------------------------------------------------
@@ -302,8 +406,10 @@ def rotate_log (log_file):
 def ensure_dir (path):
 
   try:
+    # Note: check first as the directory usually exists and this takes a single
+    # stat call while os.makedirs makes a few before failing with EEXIST.
     if not os.path.isdir (path):
-      os.makedirs (path)
+      os.makedirs (path, exist_ok = True)
   except OSError as e:
     raise Error ('Cannot create directory `%(path)s`: %(e)s' % locals ())
 
@@ -323,11 +429,25 @@ def ensure_dir (path):
 def remove_path (path, relaxed = False):
 
   try:
-    if os.path.isfile (path):
+    if not stat.S_ISDIR (os.lstat (path).st_mode):
       os.remove (path)
-    elif os.path.isdir (path):
+    else:
+      # Note: unlike shutil.rmtree, this needs no extra stat calls per entry as
+      # DirEntry gets the entry type from the directory listing itself.
+      dirs = []
+      stack = [path]
       try:
-        shutil.rmtree (path)
+        while stack:
+          d = stack.pop ()
+          dirs.append (d)
+          with os.scandir (d) as entries:
+            for e in entries:
+              if e.is_dir (follow_symlinks = False):
+                stack.append (e.path)
+              else:
+                os.remove (e.path)
+        for d in reversed (dirs):
+          os.rmdir (d)
       except OSError as e:
         if not relaxed or e.errno != 16:
           raise
@@ -336,6 +456,195 @@ def remove_path (path, relaxed = False):
       raise
 
 
+#
+# -----------------------------------------------------------------------------
+#
+# Same as os.walk but yields a pair of the directory path and a file name for
+# each file (or other non-directory entry) in the tree at path. The order is the
+# same as with os.walk. Symbolic links to directories are not followed.
+#
+# Note that unlike os.walk, this needs no stat calls per entry as DirEntry gets
+# the entry type from the directory listing itself.
+#
+
+def walk_files (path):
+
+  stack = [path]
+  while stack:
+    d = stack.pop ()
+    subdirs = []
+    with os.scandir (d) as entries:
+      for e in entries:
+        if e.is_dir ():
+          if not e.is_symlink ():
+            subdirs.append (e.path)
+        else:
+          yield d, e.name
+    stack += reversed (subdirs)
+
+
+#
+# -----------------------------------------------------------------------------
+#
+# Copies a file at path src to the dst_dir directory preserving its metadata
+# like shutil.copy2 but creates a hard link instead when possible (e.g. when
+# both are on the same file system) to avoid copying any data.
+#
+# Note that the link shares contents with src so this must only be used when
+# src is removed afterwards and neither of them is modified.
+#
+
+def copy_or_link (src, dst_dir):
+
+  dst = os.path.join (dst_dir, os.path.basename (src))
+  try:
+    try:
+      os.link (src, dst)
+    except FileExistsError:
+      # Replace it like shutil.copy2 would do.
+      os.remove (dst)
+      os.link (src, dst)
+  except (OSError, AttributeError):
+    # Not supported by the platform or file system, just copy.
+    import shutil
+    shutil.copy2 (src, dst)
+
+
+#
+# -----------------------------------------------------------------------------
+#
+# Creates a ZIP archive at zip_file containing given files with maximum
+# compression. Only file names are stored, the same way `zip -jy9` does.
+#
+# Note that this does it in-process to save on spawning `zip`.
+#
+
+def create_zip (zip_file, files):
+
+  import zipfile
+
+  with zipfile.ZipFile (zip_file, 'w', zipfile.ZIP_DEFLATED, compresslevel = 9, strict_timestamps = False) as zf:
+    for path in files:
+      zf.write (path, os.path.basename (path))
+
+
+#
+# -----------------------------------------------------------------------------
+#
+# Reads a cpio archive in the `newc` format (as produced by rpm2cpio) from
+# stream and yields a tuple (name, mode, mtime, data) for each archive member.
+# Names are relative (with the leading `./` or `/` removed). Hard links are
+# yielded as separate members sharing the same data.
+#
+
+def read_cpio (stream):
+
+  links = {}
+
+  while True:
+
+    hdr = stream.read (110)
+    if len (hdr) != 110 or hdr [:6] not in (b'070701', b'070702'):
+      raise IOError ('Invalid cpio header')
+
+    ino, mode, _, _, nlink, mtime, size, _, _, _, _, namesize, _ = \
+      [int (hdr [i:i + 8], 16) for i in range (6, 110, 8)]
+
+    # Note: both the name (following the header) and the data are padded to
+    # a multiple of 4 bytes.
+    name = stream.read (namesize) [:-1]
+    stream.read (-(110 + namesize) % 4)
+    if name == b'TRAILER!!!':
+      break
+
+    data = stream.read (size)
+    stream.read (-size % 4)
+
+    name = os.path.normpath (os.fsdecode (name)).lstrip ('/')
+    if name == '.':
+      continue
+
+    if nlink > 1 and not stat.S_ISDIR (mode):
+      # Hard links carry data only in the last entry of the link set.
+      members = links.setdefault (ino, [])
+      members.append ((name, mode, mtime))
+      if data:
+        for name, mode, mtime in links.pop (ino):
+          yield name, mode, mtime, data
+    else:
+      yield name, mode, mtime, data
+
+  for members in links.values ():
+    for name, mode, mtime in members:
+      yield name, mode, mtime, b''
+
+
+#
+# -----------------------------------------------------------------------------
+#
+# Creates a ZIP archive at zip_file with the `@unixroot` tree of all given RPMs
+# with maximum compression. The result is the same as of `zip -ry9` run on
+# `@unixroot` after unpacking all RPMs with `rpm2cpio | cpio -idm` (including
+# parent directories not present in the RPMs and members of later RPMs not
+# replacing those of earlier ones) but payloads go straight to the archive
+# instead of being written to disk and read back.
+#
+
+def zip_rpms (zip_file, rpms):
+
+  import zipfile
+
+  def add (zf, name, mode, mtime, data):
+    if stat.S_ISDIR (mode):
+      name += '/'
+    zi = zipfile.ZipInfo (name, max (time.localtime (mtime) [:6], (1980, 1, 1, 0, 0, 0)))
+    zi.create_system = 3
+    zi.external_attr = mode << 16
+    zi.compress_type = zipfile.ZIP_DEFLATED if stat.S_ISREG (mode) else zipfile.ZIP_STORED
+    # Note: ZipFile doesn't apply its compresslevel to a given ZipInfo.
+    zf.writestr (zi, data, compresslevel = 9)
+
+  with zipfile.ZipFile (zip_file, 'w') as zf:
+
+    seen = set ()
+
+    for r in rpms:
+
+      log ('Adding `%s`...' % r)
+      # Children will write to the log directly, flush what we buffered so far.
+      if g_output_file:
+        g_output_file.flush ()
+      proc = subprocess.Popen ([RPM2CPIO_EXE, r], stdout = subprocess.PIPE, stderr = g_output_file, env = g_run_env)
+      try:
+        for name, mode, mtime, data in read_cpio (proc.stdout):
+          if name in seen or not (name + '/').startswith ('@unixroot/'):
+            continue
+          # Add implicit parent directories like unpacking would create them.
+          parents = []
+          parent = os.path.dirname (name)
+          while parent and not parent in seen:
+            parents.append (parent)
+            parent = os.path.dirname (parent)
+          for parent in reversed (parents):
+            add (zf, parent, stat.S_IFDIR | 0o755, mtime, b'')
+            seen.add (parent)
+          add (zf, name, mode, mtime, data)
+          seen.add (name)
+        # Let rpm2cpio write whatever padding follows the trailer.
+        proc.stdout.read ()
+      except IOError:
+        # A broken stream is most likely due to rpm2cpio failure, report it.
+        proc.stdout.close ()
+        if not proc.wait ():
+          raise
+      finally:
+        proc.stdout.close ()
+        rc = proc.wait ()
+
+      if rc:
+        raise RunError ('%s %s' % (RPM2CPIO_EXE, r), 'exit code %d' % rc)
+
+
 #
 # -----------------------------------------------------------------------------
 #
@@ -349,11 +658,15 @@ def remove_path (path, relaxed = False):
 # command exits with a non-zero return code. To suppress this exception (and
 # get the return code together with the output, use #command_output_rc.
 #
+# Note that this and other helpers for short-lived commands below don't close
+# inherited file descriptors in the child. This is safe as Python creates them
+# non-inheritable anyway and lets subprocess skip closing them one by one (and
+# use posix_spawn where possible) which is noticeable for quick commands.
+#
 
 def command_output (command, cwd = None):
   try:
-    with open(os.devnull, 'w') as FNULL:
-      return subprocess.check_output (command, stderr = FNULL, cwd = cwd, env = g_run_env, text = True)
+    return subprocess.check_output (command, stderr = subprocess.DEVNULL, cwd = cwd, env = g_run_env, close_fds = False, text = True)
   except subprocess.CalledProcessError as e:
     raise RunError (' '.join (command), 'Non-zero exit status %s' % str (e.returncode))
   except OSError as e:
@@ -376,8 +689,7 @@ def command_output (command, cwd = None):
 
 def shell_output (command, cwd = None):
   try:
-    with open(os.devnull, 'w') as FNULL:
-      return subprocess.check_output (command, shell = True, cwd = cwd, env = g_run_env, text = True)
+    return subprocess.check_output (command, shell = True, cwd = cwd, env = g_run_env, close_fds = False, text = True)
   except subprocess.CalledProcessError as e:
     raise RunError (' '.join (command), 'Non-zero exit status %s' % str (e.returncode))
   except OSError as e:
@@ -393,8 +705,7 @@ def shell_output (command, cwd = None):
 
 def command_output_rc (command, cwd = None):
   try:
-    with open(os.devnull, 'w') as FNULL:
-      return subprocess.check_output (command, stderr = FNULL, cwd = cwd, env = g_run_env, text = True), 0
+    return subprocess.check_output (command, stderr = subprocess.DEVNULL, cwd = cwd, env = g_run_env, close_fds = False, text = True), 0
   except subprocess.CalledProcessError as e:
     return e.output, e.returncode
 
@@ -408,8 +719,7 @@ def command_output_rc (command, cwd = None):
 
 def shell_output_rc (command, cwd = None):
   try:
-    with open(os.devnull, 'w') as FNULL:
-      return subprocess.check_output (command, stderr = FNULL, shell = True, cwd = cwd, env = g_run_env, text = True), 0
+    return subprocess.check_output (command, stderr = subprocess.DEVNULL, shell = True, cwd = cwd, env = g_run_env, close_fds = False, text = True), 0
   except subprocess.CalledProcessError as e:
     return e.output, e.returncode
 
@@ -423,8 +733,7 @@ def shell_output_rc (command, cwd = None):
 
 def command_rc (command, cwd = None):
   try:
-    with open(os.devnull, 'w') as FNULL:
-      return subprocess.call (command, stdout = FNULL, stderr = FNULL, cwd = cwd, env = g_run_env)
+    return subprocess.call (command, stdout = subprocess.DEVNULL, stderr = subprocess.DEVNULL, cwd = cwd, env = g_run_env, close_fds = False)
   except OSError as e:
     raise RunError (' '.join (command), str (e))
 
@@ -438,12 +747,34 @@ def command_rc (command, cwd = None):
 
 def shell_rc (command, cwd = None):
   try:
-    with open(os.devnull, 'w') as FNULL:
-      return subprocess.call (command, stdout = FNULL, stderr = FNULL, shell = True, cwd = cwd, env = g_run_env)
+    return subprocess.call (command, stdout = subprocess.DEVNULL, stderr = subprocess.DEVNULL, shell = True, cwd = cwd, env = g_run_env, close_fds = False)
   except OSError as e:
     raise RunError (' '.join (command), str (e))
 
 
+#
+# -----------------------------------------------------------------------------
+#
+# Evaluates the given RPM macros and stores their values in the given cache
+# dict. Macros already present in the cache are skipped. All other macros are
+# evaluated with a single rpmbuild call as starting processes is expensive.
+#
+
+def eval_rpm_macros (names, cache):
+  names = [n for n in dict.fromkeys (names) if n not in cache]
+  if not names:
+    return
+  # Note: strip each value as it would be stripped if evaluated alone.
+  values = [v.strip () for v in command_output ([
+    RPMBUILD_EXE, '--eval',
+    '|'.join ('%{?' + n + '}' for n in names)
+  ]).split ('|')]
+  if len (values) != len (names):
+    # Some value contains the separator, evaluate one by one.
+    values = [command_output ([RPMBUILD_EXE, '--eval', '%%{?%s}' % n]).strip () for n in names]
+  cache.update (zip (names, values))
+
+
 #
 # -----------------------------------------------------------------------------
 #
@@ -485,9 +816,13 @@ def shell (command, cwd = None):
 #
 # Executes a pipeline of commands with each command running in its own process.
 # If regex is not None, matching lines of the pipeline's output will be returned
-# as a list. If file is not None, all output will be sent to the given file
-# object using its write method and optionally sent to the console if
-# g_args.log_to_console is also set.
+# as a list (`^` and `$` in regex match at line boundaries). The regex may be
+# either a string or a compiled regex (with re.MULTILINE). If prefilter is not
+# None, it must be a literal string contained in every match of regex: output
+# not containing it is then not searched at all. If file is not None, all
+# output will be sent to the given file object using its write method and
+# optionally sent to the console if g_args.log_to_console is also set. If
+# console is not None, it's used instead of sys.stdout for the latter.
 #
 # Note that commands is expected to be a list where each entry is also a list
 # which is passed to subprocess.Popen to execute a command. If there is only
@@ -497,12 +832,14 @@ def shell (command, cwd = None):
 # Raises Error if execution fails or terminates with a non-zero exit code.
 #
 
-def run_pipe (commands, regex = None, file = None, cwd = None):
+def run_pipe (commands, regex = None, file = None, cwd = None, prefilter = None, console = None):
 
   if not file:
     file = g_output_file
+  if console is None:
+    console = sys.stdout
 
-  recomp = re.compile (regex) if regex else None
+  recomp = re.compile (regex, re.MULTILINE) if isinstance (regex, str) else regex
   lines = []
   rc = 0
 
@@ -515,6 +852,10 @@ def run_pipe (commands, regex = None, file = None, cwd = None):
 
     cmd = commands [0]
 
+    # Children will write to file directly, flush what we buffered so far.
+    if file and not capture_output:
+      file.flush ()
+
     if len (commands) == 1:
 
       if capture_output:
@@ -544,13 +885,27 @@ def run_pipe (commands, regex = None, file = None, cwd = None):
         os.close (wpipe)
 
     if capture_output:
-      for line in iter (capture_file.readline, ''):
+      # Note: read output in large chunks as they arrive rather than line by
+      # line to save on Python-level iterations (builds are very verbose). The
+      # decoder takes care of characters and line ends split between chunks.
+      decoder = io.IncrementalNewlineDecoder (codecs.getincrementaldecoder (
+        locale.getpreferredencoding (False)) (errors = 'replace'), translate = True)
+      fd = capture_file.fileno ()
+      tail = ''
+      while True:
+        data = os.read (fd, 65536)
+        text = decoder.decode (data, final = not data)
         if recomp:
-          lines += recomp.findall (line)
+          # Only match complete lines, keep the last partial one for later.
+          head, sep, tail = (tail + text).rpartition ('\n') if data else (tail + text, '', '')
+          if not prefilter or prefilter in head:
+            lines += recomp.findall (head + sep)
         if duplicate_output:
-          sys.stdout.write (line)
+          console.write (text)
         if file:
-          file.write (line)
+          file.write (text)
+        if not data:
+          break
 
     if len (commands) > 1:
       # TODO: we ignore the child exit code at the moment due to this bug:
@@ -593,9 +948,11 @@ def run (command, regex = None, cwd = None):
 # be redirected to a log file.
 #
 
-def run_pipe_log (log_file, commands, regex = None, cwd = None):
+def run_pipe_log (log_file, commands, regex = None, cwd = None, prefilter = None, console = None):
 
-  with open (log_file, 'w', buffering = 1) as f:
+  # Note: log files are block-buffered to save on write calls for verbose
+  # output. #run_pipe flushes them before children write there directly.
+  with open (log_file, 'w', buffering = 65536) as f:
 
     start_ts = datetime.datetime.now ()
     f.write ('[%s, %s]\n' % (start_ts.strftime (DATETIME_FMT), ' | '.join (' '.join(c) for c in commands)))
@@ -604,7 +961,7 @@ def run_pipe_log (log_file, commands, regex = None, cwd = None):
 
       rc = 0
       msg = 'exit code 0'
-      lines = run_pipe (commands, regex, f, cwd = cwd)
+      lines = run_pipe (commands, regex, f, cwd = cwd, prefilter = prefilter, console = console)
 
     except RunError as e:
 
@@ -630,8 +987,8 @@ def run_pipe_log (log_file, commands, regex = None, cwd = None):
 # Shortcut to #run_pipe_log for one command.
 #
 
-def run_log (log_file, command, regex = None):
-  return run_pipe_log (log_file, [command], regex)
+def run_log (log_file, command, regex = None, prefilter = None, console = None):
+  return run_pipe_log (log_file, [command], regex, prefilter = prefilter, console = console)
 
 
 #
@@ -644,7 +1001,7 @@ def run_log (log_file, command, regex = None):
 
 def func_log (log_file, func):
 
-  with open (log_file, 'w', buffering = 1) as f:
+  with open (log_file, 'w', buffering = 65536) as f:
 
     start_ts = datetime.datetime.now ()
     f.write ('[%s, Python %s]\n' % (start_ts.strftime (DATETIME_FMT), str (func)))
@@ -661,20 +1018,20 @@ def func_log (log_file, func):
     except RunError as e:
 
       rc = 1
+      msg = 'exception ' + type (e).__name__
       f.write ('%s: %s\n' % (e.cmd, e.msg))
 
     except:
 
+      import traceback
       rc = 1
+      msg = 'exception ' + sys.exc_info () [0].__name__
       f.write ('Unexpected exception occured:\n%s' % traceback.format_exc ())
 
     finally:
 
       g_output_file = None
 
-      if rc:
-        msg = 'exception ' + sys.exc_type.__name__
-
       end_ts = datetime.datetime.now ()
       elapsed = str (end_ts - start_ts).rstrip ('0')
       f.write ('[%s, %s, %s s]\n' % (end_ts.strftime (DATETIME_FMT), msg, elapsed))
@@ -697,24 +1054,70 @@ def get_vcs_type (path):
   if not os.path.isdir (path):
     return None
 
-  path = os.path.abspath (path)
+  return find_vcs_type (os.path.abspath (path))
+
 
-  output, rc = command_output_rc (['git', 'rev-parse', '--is-inside-work-tree'], cwd = path)
-  if rc == 0 and output.strip () == 'true':
-    return 'git'
+#
+# -----------------------------------------------------------------------------
+#
+# Helper for #get_vcs_type that walks up from a given absolute directory path.
+# Results are cached per directory since specs processed in one go usually
+# share the same tree.
+#
 
-  # With SVN, things are more complicated.
+@functools.lru_cache (maxsize = 64)
+def find_vcs_type (path):
+
+  # Note: look for VCS metadata ourselves (the way git and svn do) rather than
+  # run them for each parent dir. `.git` is a file in worktrees and submodules.
   while True:
-    rc = command_rc (['svn', 'info'], cwd = path)
-    if rc == 0:
+    if os.path.exists (os.path.join (path, '.git')):
+      return 'git'
+    if os.path.isdir (os.path.join (path, '.svn')):
       return 'svn'
-    if path.endswith (os.sep):
+    parent = os.path.dirname (path)
+    if parent == path:
       break
-    path = os.path.dirname (path)
+    path = parent
 
   return None
 
 
+#
+# -----------------------------------------------------------------------------
+#
+# Returns a case-normalized real path of a given directory to be used as a key
+# when comparing directories. The result is cached for the lifetime of the
+# process as os.path.realpath needs a system call per path component.
+#
+
+@functools.lru_cache (maxsize = None)
+def dir_key (path):
+  return os.path.normcase (os.path.realpath (path))
+
+
+#
+# -----------------------------------------------------------------------------
+#
+# Returns a set of case-folded names of all entries in a given directory (or
+# None if it can't be read). The result is cached for the lifetime of the
+# process as this is used for spec dirs which don't change while a command
+# runs, so that looking up many specs reads each dir only once. Note that names
+# are folded regardless of the file system so that a name missing from the set
+# is known to be missing on both case-sensitive and case-insensitive ones (the
+# opposite is not true, so a match must still be checked with the file system).
+#
+
+@functools.lru_cache (maxsize = None)
+def dir_names (path):
+
+  try:
+    with os.scandir (path) as it:
+      return frozenset (e.name.casefold () for e in it)
+  except OSError:
+    return None
+
+
 #
 # -----------------------------------------------------------------------------
 #
@@ -740,63 +1143,73 @@ def resolve_spec (spec, spec_dirs, config):
 
   found = 0
 
-  if os.path.splitext (spec) [1] != '.spec' :
+  # Note: split the given spec only once, all names are derived from the parts.
+  dir, spec_name = os.path.split (spec)
+  spec_base, ext = os.path.splitext (spec_name)
+  if ext != '.spec':
+    spec_base = spec_name
+    spec_name += '.spec'
     spec += '.spec'
 
-  dir = os.path.dirname (spec)
   if dir:
-    spec_base = os.path.splitext (os.path.basename (spec)) [0]
     full_spec = os.path.abspath (spec)
+    full_spec_dir = os.path.dirname (full_spec)
     if os.path.isfile (full_spec):
       found = 1
-      full_spec_dir = os.path.dirname (full_spec)
+      # Note: resolve each spec dir only once and look the spec's dir (or its
+      # parent if named after the spec) up rather than comparing them in turn.
+      dir_index = {}
       for dirs in spec_dirs:
         for d in dirs:
-          if os.path.samefile (d, full_spec_dir) or \
-             os.path.samefile (os.path.join (d, spec_base), full_spec_dir):
-            found = 2
-            break
-        else:
-          continue
-        break
+          dir_index.setdefault (dir_key (d), (len (dir_index), dirs, d))
+      candidates = [dir_key (full_spec_dir)]
+      if os.path.basename (full_spec_dir) == spec_base:
+        candidates.append (dir_key (os.path.dirname (full_spec_dir)))
+      hits = [dir_index [c] for c in candidates if c in dir_index]
+      if hits:
+        found = 2
+        _, dirs, d = min (hits)
   else:
-    spec_base = os.path.splitext (spec) [0]
+    # Note: check dir listings first to only stat what may actually be there.
+    fold_spec_name, fold_spec_base = spec_name.casefold (), spec_base.casefold ()
     for dirs in spec_dirs:
       for d in dirs:
-        full_spec = os.path.abspath (os.path.join (d, spec))
-        if os.path.isfile (full_spec):
+        names = dir_names (d)
+        full_spec_dir = os.path.abspath (d)
+        full_spec = os.path.join (full_spec_dir, spec_name)
+        if (names is None or fold_spec_name in names) and os.path.isfile (full_spec):
           found = 2
           break
         else:
-          full_spec = os.path.abspath (os.path.join (d, spec_base, spec))
-          if os.path.isfile (full_spec):
+          full_spec_dir = os.path.join (full_spec_dir, spec_base)
+          full_spec = os.path.join (full_spec_dir, spec_name)
+          if (names is None or fold_spec_base in names) and os.path.isfile (full_spec):
             found = 2
             break
       else:
         continue
       break
 
+  if (found == 0):
+    if dir:
+      raise Error ('Cannot find `%s`' % spec)
+    else:
+      raise Error ('Cannot find `%s` in %s' % (spec, spec_dirs))
+
   # Load directory INI files
   if found == 2:
     config.read (os.path.join (dirs [0], SCRIPT_INI_FILE))
-    if not os.path.samefile (d, dirs [0]):
+    if d != dirs [0] and not os.path.samefile (d, dirs [0]):
       config.read (os.path.join (d, SCRIPT_INI_FILE))
 
   # Load spec INI file
-  if found >= 1:
-    config.read (os.path.join (os.path.dirname (full_spec), SCRIPT_INI_FILE))
+  config.read (os.path.join (full_spec_dir, SCRIPT_INI_FILE))
 
   # Figure out the auxiliary source dir for this spec
-  spec_aux_dir = os.path.dirname (full_spec)
+  spec_aux_dir = full_spec_dir
   if (os.path.basename (spec_aux_dir) != spec_base):
     spec_aux_dir = os.path.join (spec_aux_dir, spec_base)
 
-  if (found == 0):
-    if dir:
-      raise Error ('Cannot find `%s`' % spec)
-    else:
-      raise Error ('Cannot find `%s` in %s' % (spec, spec_dirs))
-
   log ('Spec file       : %s' % full_spec)
   log ('Spec source dir : %s' % spec_aux_dir)
 
@@ -805,10 +1218,10 @@ def resolve_spec (spec, spec_dirs, config):
     raise Error ('config', 'No value for option `general:archs`');
 
   # Load the environment.
-  g_run_env = copy.deepcopy (os.environ)
+  global g_run_env
+  g_run_env = dict (os.environ)
   if config.has_section ('environment'):
-    for var in config.options ('environment'):
-      g_run_env [var] = config.get ('environment', var)
+    g_run_env.update ((var, config.get ('environment', var)) for var in config.options ('environment'))
 
   return (full_spec, spec_base, spec_aux_dir)
 
@@ -867,7 +1280,7 @@ def read_group_config (group, config):
   ld ['rpm'] = g_rpm ['_rpmdir']
   ld ['srpm'] = g_rpm ['_srcrpmdir']
   ld ['zip'] = g_zip_dir
-  ld ['log'] = os.path.join (g_log_dir, 'build')
+  ld ['log'] = g_build_log_dir
 
   d ['repo.%s' % None] = ld
 
@@ -953,38 +1366,46 @@ def read_build_summary (spec_base, ver, repo, group_config):
       try:
 
         ln = 1
-        ver_full = f.readline ().strip ()
-        if not re.match (r'^%s$' % VER_FULL_REGEX, ver_full):
+        # Note: summaries are small, read them in one go.
+        lines = iter (f.read ().splitlines ())
+        ver_full = next (lines, '').strip ()
+        if not VER_FULL_RE.match (ver_full):
           raise Error ('Invalid version specification: `%s`' % ver_full)
 
         ln = 2
-        build_user, build_time = f.readline ().strip ().split ('|')
-        if not re.match (r'^%s$' % BUILD_USER_REGEX, build_user):
+        build_user, build_time = next (lines, '').strip ().split ('|')
+        if not BUILD_USER_RE.match (build_user):
           raise Error ('Invalid build user specification: `%s`' % build_user)
         build_time = float (build_time)
 
         rpms = dict ()
         hist = []
 
-        for line in f:
+        for line in lines:
 
           ln += 1
 
           if line.startswith ('>'):
             # Parse move history.
-            move_repo, move_user, move_time = line.split ('|')
+            move_repo, _, move_time = line.partition ('|')
+            move_user, _, move_time = move_time.partition ('|')
             move_repo = move_repo.lstrip('>')
             hist.append ([move_repo, move_user, float (move_time)])
             continue
 
-          arch, name, mtime, size = line.strip ().split ('|')
+          # Note: partition doesn't build lists, a wrong number of fields will
+          # still make float or int below raise ValueError.
+          arch, _, size = line.strip ().partition ('|')
+          name, _, size = size.partition ('|')
+          mtime, _, size = size.partition ('|')
           mtime = float (mtime)
           size = int (size)
           path = resolve_path (name, arch, repo, group_config)
 
-          if os.path.getmtime (path) != mtime:
+          st = os.stat (path)
+          if st.st_mtime != mtime:
             raise Error ('%s:%s' % (summary, ln), 'Recorded mtime differs from actual for `%s`' % path)
-          if os.path.getsize (path) != size:
+          if st.st_size != size:
             raise Error ('%s:%s' % (summary, ln), 'Recorded size differs from actual for `%s`' % path)
 
           if arch in ['srpm', 'zip']:
@@ -1022,6 +1443,18 @@ class CommandCancelled (BaseException):
     BaseException.__init__ (self, 'Command cancelled')
 
 
+#
+# -----------------------------------------------------------------------------
+#
+# Returns a compiled regex that matches names of arch or noarch RPMs written by
+# rpmbuild in its output (for #run_pipe and friends).
+#
+
+@functools.lru_cache (maxsize = None)
+def wrote_re (arch):
+  return re.compile (r'^Wrote: +(.+\.(?:%s|noarch)\.rpm)$' % re.escape (arch), re.MULTILINE)
+
+
 #
 # -----------------------------------------------------------------------------
 #
@@ -1054,15 +1487,26 @@ def get_spec_archs (config, spec_base):
 
 def build_prepare (full_spec, spec_base, spec_aux_dir, source_dir, archs, config):
 
+  import shutil
+
   ensure_dir (source_dir)
 
-  # Copy all files from aux dir but spec itself.
+  # Copy all files from aux dir but spec itself. Skip files whose copies are
+  # already up to date (e.g. left from a previous test run).
 
-  for f in os.listdir (spec_aux_dir):
-    ff = os.path.join (spec_aux_dir, f)
-    if os.path.samefile (ff, full_spec):
-      continue
-    shutil.copy2 (ff, source_dir)
+  spec_st = os.stat (full_spec)
+  with os.scandir (spec_aux_dir) as it:
+    for entry in it:
+      src_st = entry.stat ()
+      if os.path.samestat (src_st, spec_st):
+        continue
+      try:
+        dst_st = os.stat (os.path.join (source_dir, entry.name))
+        if dst_st.st_size == src_st.st_size and dst_st.st_mtime >= src_st.st_mtime:
+          continue
+      except FileNotFoundError:
+        pass
+      shutil.copy2 (entry.path, source_dir)
 
   # Get legacy runtime.
 
@@ -1111,61 +1555,123 @@ def build_prepare (full_spec, spec_base, spec_aux_dir, source_dir, archs, config
 
         # Check filenames and timestamps
         log ('Checking package %s...' % rpm)
-        if not os.path.isfile (rpm):
+        try:
+          st = os.stat (rpm)
+        except FileNotFoundError:
+          st = None
+        if not st or not stat.S_ISREG (st.st_mode):
           raise Error ('File not found: %s' % rpm)
 
-        ts = os.path.getmtime (rpm)
+        ts = st.st_mtime
 
-        old_ts, old_rpm, old_name, old_ver = [None, None, None, None]
+        # Note: compare the whole 'done' mark at once rather than parse it, a
+        # missing or damaged mark simply causes re-extraction.
+        stamp = '%s|%s|%s|%s' % (ts, rpm, name, ver)
         tgt_list = tgt_dir + '.list'
-        if os.path.isfile (tgt_list):
+        try:
           with open (tgt_list, 'r') as l:
-            try:
-              old_ts, old_rpm, old_name, old_ver = l.readline ().strip ().split ('|')
-              old_ts = float (old_ts)
-            except ValueError:
-              raise Error (rpm, 'Incorrect number of fields')
+            old_stamp = l.readline ().strip ()
+        except FileNotFoundError:
+          old_stamp = None
 
-        if old_ts != ts or old_rpm != rpm or old_name != name or old_ver != ver:
+        if old_stamp != stamp:
           log ('Extracting to %s...' % tgt_dir)
           remove_path (tgt_list)
           remove_path (tgt_dir)
           ensure_dir (tgt_dir)
           os.chdir (tgt_dir)
           run_pipe ([[RPM2CPIO_EXE, rpm], [CPIO_EXE, '-idm', mask]])
-          # Save the file list for later use.
-          all_files = []
-          with open (tgt_dir + '.files.list', 'w') as l:
-            for root, dirs, files in os.walk (tgt_dir):
-              for f in files:
-                f = os.path.join (root [len (tgt_dir):], f)
-                all_files.append (f)
-                l.write (f + '\n')
-          # Now try to locate the debuginfo package and extract *.dbg from it.
+          # Try to locate the debuginfo package to extract *.dbg from it below.
           debug_rpm = os.path.join (repo_config ['rpm'], arch, '%s-debuginfo-%s.%s.rpm' % (name, ver, arch))
           have_debug_rpm = os.path.isfile (debug_rpm)
           if not have_debug_rpm:
             debug_rpm = os.path.join (repo_config ['rpm'], arch, '%s-debug-%s.%s.rpm' % (name, ver, arch))
             have_debug_rpm = os.path.isfile (debug_rpm)
+          # Save the file list for later use (and collect debug files in the
+          # same pass).
+          all_files = []
+          dbg_files = []
+          for root, f in walk_files (tgt_dir):
+            f = os.path.join (root [len (tgt_dir):], f)
+            all_files.append (f + '\n')
+            if have_debug_rpm:
+              dbg_files.append (os.path.splitext (f) [0] + '.dbg')
+          with open (tgt_dir + '.files.list', 'w') as l:
+            l.write (''.join (all_files))
           if have_debug_rpm:
             log ('Found debug info package %s, extracting...' % debug_rpm)
             # Save the file for later inclusion into debugfiles.list (%debug_package magic in brp-strip-os2).
             dbgfilelist = tgt_dir + '.debugfiles.list'
             remove_path (dbgfilelist)
-            masks = []
             with open (dbgfilelist, 'w') as l:
-              for f in all_files:
-                f = os.path.splitext (f) [0] + '.dbg'
-                l.write (f + '\n')
-                masks.append ('*' + f)
-            run_pipe ([[RPM2CPIO_EXE, debug_rpm], [CPIO_EXE, '-idm'] + masks])
+              l.write (''.join (f + '\n' for f in dbg_files))
+            # Note: pass masks to cpio in a file as there may be too many of
+            # them for the command line.
+            dbgmasks = tgt_dir + '.debugmasks'
+            with open (dbgmasks, 'w') as l:
+              l.write (''.join ('*' + f + '\n' for f in dbg_files))
+            try:
+              run_pipe ([[RPM2CPIO_EXE, debug_rpm], [CPIO_EXE, '-idm', '-E', dbgmasks]])
+            finally:
+              remove_path (dbgmasks)
           # Put the 'done' mark.
           with open (tgt_list, 'w') as l:
-            l.write ('%s|%s|%s|%s\n'  % (ts, rpm, name, ver))
+            l.write (stamp + '\n')
 
         with open (os.path.join (source_dir, '%s-legacy' % spec_base, 'abi.list'), 'w') as l:
           l.write (' '.join (abi_list) + '\n')
 
+
+#
+# -----------------------------------------------------------------------------
+#
+# Builds RPMs of a spec for all given archs (helper for #build_cmd). Returns a
+# tuple with a list of RPMs of the base (first) arch and a dict with a list of
+# RPMs per arch plus all noarch RPMs under the `noarch` key. If check is not
+# None, it's called before building each arch (and may raise to abort).
+#
+
+def build_arch_rpms (archs, log_base, source_dir, full_spec, check = None):
+
+  base_rpms = None
+  arch_rpms = dict ()
+  noarch_rpms = set ()
+
+  for arch in archs:
+
+    if check:
+      check ()
+
+    log_file = os.path.join (log_base, '%s.log' % arch)
+    log ('Creating RPMs for `%(arch)s` target (logging to %(log_file)s)...' % locals ())
+
+    rpms = run_log (log_file, [RPMBUILD_EXE, '--target=%s' % arch, '-bb',
+                               '--define=_sourcedir %s' % source_dir, full_spec],
+                    wrote_re (arch), prefilter = 'Wrote:')
+
+    if len (rpms):
+      # Save the base arch RPMs for later.
+      if not base_rpms:
+        base_rpms = rpms
+      # Deal with noarch.
+      arch_only = []
+      for r in rpms:
+        if r.endswith ('.noarch.rpm'):
+          noarch_rpms.add (r)
+        else:
+          arch_only.append (r)
+      if len (arch_only) == 0:
+        log ('Skipping other targets because `%s` produced only `noarch` RPMs.' % arch)
+        break
+      arch_rpms [arch] = arch_only
+    else:
+      raise Error ('Cannot find `.(%(arch)s|noarch).rpm` file names in `%(log_file)s`.' % locals ())
+
+  arch_rpms ['noarch'] = sorted (noarch_rpms)
+
+  return base_rpms, arch_rpms
+
+
 #
 # -----------------------------------------------------------------------------
 #
@@ -1186,12 +1692,15 @@ def build_cmd ():
 
     log ('Targets: ' + ', '.join (archs) + ', ZIP (%s), SRPM' % archs [0])
 
-    log_base = os.path.join (g_log_dir, 'build', spec_base)
+    log_base = os.path.join (g_build_log_dir, spec_base)
 
     summary = os.path.join (log_base, 'summary')
-    if os.path.isfile (summary):
+    try:
       with open (summary, 'r') as f:
         ver = f.readline ().strip ()
+    except FileNotFoundError:
+      ver = None
+    if ver is not None:
       if g_args.force_command:
         log_note ('Overwriting previous build of `%s` (%s) due to -f option.' % (spec_base, ver))
       else:
@@ -1201,57 +1710,48 @@ def build_cmd ():
     remove_path (log_base, relaxed = True)
     ensure_dir (log_base)
 
-    # Generate RPMs for all architectures.
+    # Generate SRPM in the background while RPMs are being built as it only
+    # needs sources. Note that RPMs for different archs can't be built in
+    # parallel as they share the build dir and write the same noarch RPMs.
+    # The console copy of the SRPM output (-l) is held back until the RPMs are
+    # done to keep it from interleaving with theirs.
 
-    base_rpms = None
-    arch_rpms = dict ()
-    noarch_rpms = dict ()
+    import concurrent.futures
 
-    for arch in archs:
+    srpm_log_file = os.path.join (log_base, 'srpm.log')
+    srpm_console = io.StringIO ()
 
-      log_file = os.path.join (log_base, '%s.log' % arch)
-      log ('Creating RPMs for `%(arch)s` target (logging to %(log_file)s)...' % locals ())
+    def get_srpm ():
+      log ('Creating SRPM (logging to %s)...' % srpm_log_file)
+      try:
+        return srpm_future.result () [0]
+      finally:
+        sys.stdout.write (srpm_console.getvalue ())
 
-      rpms = run_log (log_file, [RPMBUILD_EXE, '--target=%s' % arch, '-bb',
-                                 '--define=_sourcedir %s' % source_dir, full_spec],
-                      r'^Wrote: +(.+\.(?:%s|noarch)\.rpm)$' % arch)
+    def check_srpm ():
+      # Don't wait for all RPMs to report a failed SRPM.
+      if srpm_future.done () and srpm_future.exception ():
+        get_srpm ()
 
-      if len (rpms):
-        # Save the base arch RPMs for later.
-        if not base_rpms:
-          base_rpms = rpms
-        # Deal with noarch.
-        arch_only = []
-        for r in rpms:
-          if r.endswith ('.noarch.rpm'):
-            noarch_rpms [r] = True
-          else:
-            arch_only.append (r)
-        if len (arch_only) == 0:
-          log ('Skipping other targets because `%s` produced only `noarch` RPMs.' % arch)
-          break
-        arch_rpms [arch] = arch_only
-      else:
-        raise Error ('Cannot find `.(%(arch)s|noarch).rpm` file names in `%(log_file)s`.' % locals ())
+    with concurrent.futures.ThreadPoolExecutor (max_workers = 1) as executor:
 
-    arch_rpms ['noarch'] = noarch_rpms.keys ()
+      srpm_future = executor.submit (run_log, srpm_log_file, [RPMBUILD_EXE, '-bs',
+                                     '--define=_sourcedir %s' % source_dir, full_spec],
+                                     WROTE_SRPM_RE, prefilter = 'Wrote:', console = srpm_console)
 
-    # Generate SRPM.
+      # Generate RPMs for all architectures.
 
-    log_file = os.path.join (log_base, 'srpm.log')
-    log ('Creating SRPM (logging to %s)...' % log_file)
+      base_rpms, arch_rpms = build_arch_rpms (archs, log_base, source_dir, full_spec, check_srpm)
 
-    srpm = run_log (log_file, [RPMBUILD_EXE, '-bs',
-                               '--define=_sourcedir %s' % source_dir, full_spec],
-                    r'^Wrote: +(.+\.src\.rpm)$') [0]
+      srpm = get_srpm ()
 
     if not srpm:
-      raise Error ('Cannot find `.src.rpm` file name in `%s`.' % log_file)
+      raise Error ('Cannot find `.src.rpm` file name in `%s`.' % srpm_log_file)
 
     # Find package version.
 
     srpm_base = os.path.basename (srpm)
-    spec_ver = re.match (r'(%s)-(%s)\.src\.rpm' % (spec_base, VER_FULL_REGEX), srpm_base)
+    spec_ver = SRPM_NAME_VER_RE.match (srpm_base)
     if not spec_ver or spec_ver.lastindex != 2:
       raise Error ('Cannot deduce package version from `%s` with spec_base `%s`' % (srpm, spec_base),
                    hint = 'Check that Release value ends with %{?dist} macro in `%s`.spec' % spec_base)
@@ -1271,35 +1771,28 @@ def build_cmd ():
 
     def gen_zip ():
 
-      os.chdir (g_zip_dir)
-      remove_path ('@unixroot')
-
-      for r in base_rpms:
-        log ('Unpacking `%s`...' % r)
-        run_pipe ([[RPM2CPIO_EXE, r], [CPIO_EXE, '-idm']])
-
-      remove_path (zip_file)
       log ('Creating `%s`...' % zip_file)
-      run_pipe ([['zip', '-mry9', zip_file, '@unixroot']])
+      zip_rpms (zip_file, base_rpms)
 
     func_log (log_file, gen_zip)
 
     # Write a summary with all generated packages for further reference.
 
     def file_data (path):
-      return '%s|%s|%s' % (os.path.basename (path), os.path.getmtime (path), os.path.getsize (path))
+      st = os.stat (path)
+      return '%s|%s|%s' % (os.path.basename (path), st.st_mtime, st.st_size)
+
+    lines = [ver_full,
+             '%s@%s|%s' % (g_username, g_hostname, time.time ()),
+             'srpm|%s' % file_data (srpm),
+             'zip|%s' % file_data (zip_file)]
+    lines.extend ('%s|%s' % (a, file_data (r)) for a, rs in arch_rpms.items () for r in rs)
 
     with open ('%s.tmp' % summary, 'w') as f:
-      f.write (ver_full + '\n')
-      f.write ('%s@%s|%s\n' % (g_username, g_hostname, time.time ()))
-      f.write ('srpm|%s\n' % file_data (srpm))
-      f.write ('zip|%s\n' % file_data (zip_file))
-      for a in arch_rpms.keys ():
-        for r in arch_rpms [a]:
-          f.write ('%s|%s\n' % (a, file_data (r)))
+      f.write ('\n'.join (lines) + '\n')
 
     # Everything succeeded.
-    os.rename ('%s.tmp' % summary, summary)
+    os.replace ('%s.tmp' % summary, summary)
     log ('Generated all packages for version %s.' % ver_full)
 
 
@@ -1336,7 +1829,7 @@ def test_cmd ():
     if g_args.STEP in ['all', 'install']:
       build_prepare (full_spec, spec_base, spec_aux_dir, source_dir, archs, config)
 
-    log_base = os.path.join (g_log_dir, 'test', spec_base)
+    log_base = os.path.join (g_test_log_dir, spec_base)
     if not purge:
       ensure_dir (log_base)
 
@@ -1345,11 +1838,12 @@ def test_cmd ():
       rpms = set ()
       for l in ['all', 'pack']:
         lf = os.path.join (log_base, l + '.log')
-        if os.path.isfile (lf):
+        # Note: scan the whole log at once, the regex works in multi-line mode.
+        try:
           with open (lf, 'r') as f:
-            for line in iter (f.readline, ''):
-              for r in re.findall (r'^Wrote: +(.+\.(?:%s|noarch)\.rpm)$' % base_arch, line):
-                rpms.add (r)
+            rpms.update (wrote_re (base_arch).findall (f.read ()))
+        except FileNotFoundError:
+          pass
 
       if len (rpms) > 0:
         for r in rpms:
@@ -1375,7 +1869,7 @@ def test_cmd ():
 
     rpms = run_log (log_file, [RPMBUILD_EXE, '--target=%s' % base_arch, '--define=dist %nil',
                                '--define=_sourcedir %s' % source_dir] + opts + [full_spec],
-                    r'^Wrote: +(.+\.(?:%s|noarch)\.rpm)$' % base_arch)
+                    wrote_re (base_arch), prefilter = 'Wrote:')
 
     # Show the generated RPMs when appropriate.
     if g_args.STEP == 'all' or g_args.STEP == 'pack':
@@ -1394,6 +1888,8 @@ def test_cmd ():
 
 def move_cmd ():
 
+  import shutil
+
   is_upload = g_args.COMMAND == 'upload'
   is_remove = g_args.COMMAND == 'remove'
   is_remove_local = is_remove and not g_args.GROUP
@@ -1404,6 +1900,8 @@ def move_cmd ():
     for dirs in g_spec_dirs:
       config.read (os.path.join (dirs [0], SCRIPT_INI_FILE))
 
+  group_config = None
+
   for spec in g_args.SPEC.split (','):
 
     if is_upload or is_remove_local:
@@ -1417,7 +1915,7 @@ def move_cmd ():
         spec, ver = spec.split (':', 1)
       except ValueError:
         raise Error ('No version given for `%s`' % spec, hint = 'Use `list` command to get available versions')
-      if not re.match (r'^%s$' % VER_FULL_REGEX, ver):
+      if not VER_FULL_RE.match (ver):
         raise Error ('Invalid version specification: `%s`' % ver)
       spec_base = spec # Don't deal with path or ext here.
 
@@ -1428,7 +1926,11 @@ def move_cmd ():
 
     from_repo = None
 
-    group_config = read_group_config (group, config)
+    # Note: config only changes from spec to spec when spec INIs are loaded.
+    if not group_config or is_upload or is_remove_local:
+      group_config = read_group_config (group, config)
+      # Note: None is the local build repo (see #read_group_config).
+      repo_configs = {r: group_config ['repo.%s' % r] for r in group_config.get ('repos', []) + [None]}
 
     if not is_remove_local:
 
@@ -1437,7 +1939,7 @@ def move_cmd ():
       if not is_upload:
         # Look for a summary in one of the group's repos.
         for repo in repos:
-          from_summary = os.path.join (group_config ['repo.%s' % repo] ['log'], spec_base, ver, 'summary')
+          from_summary = os.path.join (repo_configs [repo] ['log'], spec_base, ver, 'summary')
           if os.path.isfile (from_summary):
             from_repo = repo
             break
@@ -1450,7 +1952,7 @@ def move_cmd ():
 
     else:
 
-      from_summary = os.path.join (group_config ['repo.%s' % from_repo] ['log'], spec_base, 'summary')
+      from_summary = os.path.join (repo_configs [from_repo] ['log'], spec_base, 'summary')
 
     prompt = False
 
@@ -1473,9 +1975,9 @@ def move_cmd ():
       if from_repo == to_repo:
         raise Error ('Source and target repository are the same: `%s`' % (to_repo))
 
-    from_repo_config = group_config ['repo.%s' % from_repo]
+    from_repo_config = repo_configs [from_repo]
     if not is_remove:
-      to_repo_config = group_config ['repo.%s' % to_repo]
+      to_repo_config = repo_configs [to_repo]
 
     log ('From repository : %s' % from_repo_config ['base'])
     if not is_remove:
@@ -1524,7 +2026,7 @@ def move_cmd ():
       elif is_upload:
         # Search for a summary in any group's repo.
         for repo in repos:
-          maybe_summary = os.path.join (group_config ['repo.%s' % repo] ['log'], spec_base, ver_full, 'summary')
+          maybe_summary = os.path.join (repo_configs [repo] ['log'], spec_base, ver_full, 'summary')
           if os.path.isfile (maybe_summary):
             if g_args.force_command:
               log_note ('Ignoring existing build of `%s` in repository `%s` due to -f option.' % (spec_base, repo))
@@ -1539,17 +2041,16 @@ def move_cmd ():
       if not is_remove:
         log ('Removing old build''s packages and logs for `%s`...' % old_summary)
       _, _, _, old_rpms, _ = read_build_summary (spec_base, None if is_remove_local else ver_full, old_repo, group_config)
+      old_files = []
       for arch in old_rpms.keys ():
         if arch in ['srpm', 'zip']:
-          f = old_rpms [arch]
-          if is_remove:
-            log ('Removing %s...' % f)
-          os.remove (f)
+          old_files.append (old_rpms [arch])
         else:
-          for f in old_rpms [arch]:
-            if is_remove:
-              log ('Removing %s...' % f)
-            os.remove (f)
+          old_files.extend (old_rpms [arch])
+      if is_remove:
+        log ('\n'.join ('Removing %s...' % f for f in old_files))
+      for f in old_files:
+        os.remove (f)
       if is_remove:
         log ('Removing logs in %s...' % os.path.dirname (old_summary))
       remove_path (os.path.dirname (old_summary))
@@ -1573,15 +2074,30 @@ def move_cmd ():
       spec_file = os.path.basename (full_spec)
 
       if vcs == 'GIT':
-        # Check for untracked files in spec AUX dir.
-        untracked = command_output (['git', 'ls-files', '--other', '--', '.'], cwd = spec_aux_dir)
-        if untracked.strip () != '':
-          raise Error ('Untracked files are found in `%s`:\n%s\n\n' % (spec_aux_dir, '\n'.join ('  %s' % f for f in untracked.splitlines ())),
+        # Get untracked and modified (staged or not) files with one git call.
+        # Note: paths are relative to the repository root in this mode.
+        commit_files = ['.'] if spec_dir == spec_aux_dir else [spec_file, spec_aux_dir]
+        untracked, modified = [], []
+        entries = iter (command_output (['git', 'status', '--porcelain', '-z', '--untracked-files=all', '--'] + commit_files, cwd = spec_dir).split ('\0'))
+        for e in entries:
+          xy, path = e [:2], e [3:]
+          if not path:
+            continue
+          if xy == '??':
+            untracked.append (path)
+          else:
+            modified.append (os.path.basename (path))
+            # Renames and copies are followed by the original path.
+            if xy [0] in 'RC':
+              next (entries, None)
+        # Check for untracked files among files to be committed (the spec file
+        # and its AUX dir).
+        if untracked:
+          raise Error ('Untracked files are found among files to be committed with `%s` '
+                       '(paths are relative to the repository root):\n%s\n\n' %
+                       (full_spec, '\n'.join ('  %s' % f for f in untracked)),
                        hint = 'Add these files with `git add` (or remove/ignore them) manually and retry.')
         # Check for modified files.
-        commit_files = ['.'] if spec_dir == spec_aux_dir else [spec_file, spec_aux_dir]
-        modified = [os.path.basename (f) for f in command_output (['git', 'diff', '--cached', '--name-only', '--'] + commit_files, cwd = spec_dir).splitlines ()]
-        modified += [os.path.basename (f) for f in command_output (['git', 'diff', '--name-only', '--'] + commit_files, cwd = spec_dir).splitlines ()]
         if not spec_file in modified:
           last_spec_msg = command_output (['git', 'log', '-n', '1', '--pretty=format:%s', '--', spec_file], cwd = spec_dir).strip ()
           if last_spec_msg != commit_msg:
@@ -1628,10 +2144,11 @@ def move_cmd ():
           for src in rpms [arch]:
             rpms_to_copy.append ((src, dst))
 
+      # Note: sources are removed below so they may be linked instead.
       for src, dst in rpms_to_copy:
         log ('Copying %s -> %s...' % (src, dst))
         ensure_dir (dst)
-        shutil.copy2 (src, dst)
+        copy_or_link (src, dst)
 
       # Copy build logs and summary.
 
@@ -1648,7 +2165,7 @@ def move_cmd ():
         for arch in rpms.keys ():
           if arch != 'noarch':
             zip_files.append (os.path.join (from_log, '%s.log' % arch))
-        run_pipe ([['zip', '-jy9', zip_path] + zip_files])
+        create_zip (zip_path, zip_files)
 
       to_log = os.path.join (to_repo_config ['log'], spec_base, ver_full)
 
@@ -1657,9 +2174,14 @@ def move_cmd ():
       remove_path (to_log)
       ensure_dir (to_log)
 
+      # Note: local logs are archived below and the copied summary is then
+      # modified, so only link those that will be removed.
       logs_to_copy = [zip_path, os.path.join (from_log, 'summary')]
       for src in logs_to_copy:
-        shutil.copy2 (src, to_log)
+        if is_upload:
+          shutil.copy2 (src, to_log)
+        else:
+          copy_or_link (src, to_log)
 
       # Record the transition.
       with open (to_summary, 'a') as f:
@@ -1718,6 +2240,8 @@ def move_cmd ():
 
 def list_cmd ():
 
+  import fnmatch, glob
+
   # No need in per-spec INI loading, load them from each non-plus spec_dir instead.
   config = copy.deepcopy (g_config)
   for dirs in g_spec_dirs:
@@ -1725,9 +2249,16 @@ def list_cmd ():
 
   group_mask, repo_mask = (g_args.GROUP.split (':', 1) + ['*']) [:2]
 
+  # Compile masks once instead of letting fnmatch do it on each call (note
+  # that fnmatch.fnmatch also normalizes case so we do the same).
+  def mask_re (mask):
+    return re.compile (fnmatch.translate (os.path.normcase (mask)))
+  group_re = mask_re ('group.%s' % group_mask)
+  repo_re = mask_re (repo_mask)
+
   for section in config.sections ():
 
-    if fnmatch.fnmatch (section, 'group.%s' % group_mask):
+    if group_re.match (os.path.normcase (section)):
 
       _, group = section.split ('.')
       group_config = read_group_config (group, config)
@@ -1735,30 +2266,30 @@ def list_cmd ():
 
       for repo in repos:
 
-        if fnmatch.fnmatch (repo, repo_mask):
+        if repo_re.match (os.path.normcase (repo)):
 
           log_base = os.path.join (group_config ['repo.%s' % repo] ['log'])
 
-          # Ignore missing log dirs.
-          files = []
-          try:
-            files = os.listdir (log_base)
-          except OSError as e:
-            if e.errno == 2:
-              pass
+          # Let glob find matching spec dirs (it doesn't list the log dir at all
+          # for plain spec names). Missing log dirs simply give no matches.
+          # Note: use scandir to get the entry type without an extra stat call
+          # per entry where the platform allows.
+          for spec_mask in g_args.SPEC.split (','):
+            for log_dir in glob.iglob (os.path.join (glob.escape (log_base), spec_mask)):
 
-          for spec in files:
+              spec = os.path.basename (log_dir)
 
-            log_dir = os.path.join (log_base, spec)
+              try:
+                with os.scandir (log_dir) as it:
+                  ver_entries = list (it)
+              except NotADirectoryError:
+                continue
 
-            if os.path.isdir (log_dir):
-              for spec_mask in g_args.SPEC.split (','):
-                if fnmatch.fnmatch (spec, spec_mask):
-                  for ver in os.listdir (log_dir):
-                    if os.path.isdir (os.path.join (log_dir, ver)):
+              for ver_entry in ver_entries:
+                if ver_entry.is_dir ():
 
-                      # NOTE: Don't call #read_build_summary to save time.
-                      log ('%-20s %s:%s' % ('%s:%s' % (group, repo), spec, ver))
+                  # NOTE: Don't call #read_build_summary to save time.
+                  log ('%-20s %s:%s' % ('%s:%s' % (group, repo), spec, ver_entry.name))
 
 
 #
@@ -1779,18 +2310,18 @@ def info_cmd ():
   except ValueError:
     raise Error ('No repository given after `%s`' % g_args.GROUP)
 
+  group_config = read_group_config (group, config)
+  repo_config = group_config ['repo.%s' % repo]
+
   for spec in g_args.SPEC.split (','):
 
     try:
       spec, ver = spec.split (':', 1)
     except ValueError:
       raise Error ('No version given for `%s`' % spec, hint = 'Use `list` command to get available versions')
-    if not re.match (r'^%s$' % VER_FULL_REGEX, ver):
+    if not VER_FULL_RE.match (ver):
       raise Error ('Invalid version specification: `%s`' % ver)
 
-    group_config = read_group_config (group, config)
-    repo_config = group_config ['repo.%s' % repo]
-
     try:
       ver_full, build_user, build_time, rpms, hist = read_build_summary (spec, ver, repo, group_config)
     except NoBuildSummary as e:
@@ -1801,36 +2332,26 @@ def info_cmd ():
     log ('Build user   : %s' % build_user)
     log ('Build time   : %s' % to_localtimestr (build_time))
 
+    # Note: collect all lines first to log each list at once.
+    rpm_lines = []
+    for rpm in rpms.keys ():
+      if rpm in ['srpm', 'zip']:
+        rpm_lines.append (os.path.basename (rpms [rpm]))
+      else:
+        rpm_lines.extend (os.path.basename (r) for r in rpms [rpm])
+    hist_lines = ['-> %s by %s on %s' % (h [0], h [1], to_localtimestr(h [2])) for h in hist]
+
     if True:
-      first = True
-      for rpm in rpms.keys ():
-        str = 'RPMs         : %s' if first else '             : %s'
-        first = False
-        if rpm in ['srpm', 'zip']:
-          log (str % os.path.basename (rpms [rpm]))
-        else:
-          for r in rpms [rpm]:
-            log (str % os.path.basename (r))
+      if rpm_lines:
+        log ('\n'.join (['RPMs         : ' + rpm_lines [0]] + ['             : ' + l for l in rpm_lines [1:]]))
     else:
-      log ('RPMs         :')
-      for arch in rpms.keys ():
-        str = '  %s'
-        if arch in ['srpm', 'zip']:
-          log (str % os.path.basename (rpms [arch]))
-        else:
-          for r in rpms [arch]:
-            log (str % os.path.basename (r))
+      log ('\n'.join (['RPMs         :'] + ['  ' + l for l in rpm_lines]))
 
     if True:
-      first = True
-      for h in hist:
-        str = 'Move history :' if first else '             :'
-        first = False
-        log ('%s -> %s by %s on %s' % (str, h [0], h [1], to_localtimestr(h [2])))
+      if hist_lines:
+        log ('\n'.join (['Move history : ' + hist_lines [0]] + ['             : ' + l for l in hist_lines [1:]]))
     else:
-      log ('Move history :')
-      for h in hist:
-        log ('  -> %s by %s on %s' % (h [0], h [1], to_localtimestr(h [2])))
+      log ('\n'.join (['Move history :'] + ['  ' + l for l in hist_lines]))
 
 #
 # =============================================================================
@@ -1840,8 +2361,8 @@ def info_cmd ():
 
 # Fix slashes in common environment vars to ensure backslashes won't slip in
 # (which is generally bad because of escaping hell when passing them around).
-for v in ['HOME', 'TMP', 'TEMP', 'TMPDIR', 'PATH']:
-  os.environ [v] = os.environ [v].replace ('\\', '/')
+# Note: skip unset ones (e.g. TMP and TEMP are usually missing on Unix).
+os.environ.update ({v: os.environ [v].replace ('\\', '/') for v in ['HOME', 'TMP', 'TEMP', 'TMPDIR', 'PATH'] if v in os.environ})
 
 # Script's start timestamp.
 g_start_ts = datetime.datetime.now ()
@@ -1876,95 +2397,126 @@ g_cmds = g_cmdline.add_subparsers (dest = 'COMMAND', metavar = 'COMMAND', help =
 
 # Parse data for test command.
 
-g_cmd_test = g_cmds.add_parser ('test',
-  help = 'do test build (one arch)', description = '''
+def add_test_cmd ():
+
+  cmd = g_cmds.add_parser ('test',
+    help = 'do test build (one arch)', description = '''
 Runs a test build of SPEC for one architecture. STEP may speficty a rpmbuild
 shortcut to go to a specific build step. If STEP is `purge`, it will delete all
 RPM files and logs generated by a last successfl test build.''',
-  formatter_class = g_cmdline.formatter_class)
+    formatter_class = g_cmdline.formatter_class)
+
+  cmd.add_argument ('STEP', nargs = '?', choices = ['all', 'prep', 'build', 'install', 'pack', 'purge'], default = 'all', help = 'build step: %(choices)s', metavar = 'STEP')
+  cmd.add_argument ('SPEC', help = 'spec file (comma-separated if more than one)')
+  cmd.set_defaults (cmd = test_cmd)
 
-g_cmd_test.add_argument ('STEP', nargs = '?', choices = ['all', 'prep', 'build', 'install', 'pack', 'purge'], default = 'all', help = 'build step: %(choices)s', metavar = 'STEP')
-g_cmd_test.add_argument ('SPEC', help = 'spec file (comma-separated if more than one)')
-g_cmd_test.set_defaults (cmd = test_cmd)
 
 # Parse data for build command.
 
-g_cmd_build = g_cmds.add_parser ('build',
-  help = 'do normal build (all configured archs)', description = '''
+def add_build_cmd ():
+
+  cmd = g_cmds.add_parser ('build',
+    help = 'do normal build (all configured archs)', description = '''
 Builds SPEC for all configured architectures. If SPEC does not have a path (recommended),
 it will be searcherd in configured SPEC directories.''',
-  formatter_class = g_cmdline.formatter_class)
+    formatter_class = g_cmdline.formatter_class)
+
+  cmd.add_argument ('SPEC', help = 'spec file (comma-separated if more than one)')
+  cmd.set_defaults (cmd = build_cmd)
 
-g_cmd_build.add_argument ('SPEC', help = 'spec file (comma-separated if more than one)')
-g_cmd_build.set_defaults (cmd = build_cmd)
 
 # Parse data for upload command.
 
-g_cmd_upload = g_cmds.add_parser ('upload',
-  help = 'upload build results to repository group', description = '''
+def add_upload_cmd ():
+
+  cmd = g_cmds.add_parser ('upload',
+    help = 'upload build results to repository group', description = '''
 Uploads all RPMs generated from SPEC to a repository of a configured repository group.
 If REPO is not specified, the first GROUP's repository is used as a target.''',
-  formatter_class = g_cmdline.formatter_class)
+    formatter_class = g_cmdline.formatter_class)
+
+  cmd.add_argument ('GROUP', help = 'repository group and optional repository name from INI file', metavar = 'GROUP[:REPO]')
+  cmd.add_argument ('SPEC', help = 'spec file (comma-separated if more than one)')
+  cmd.set_defaults (cmd = move_cmd)
 
-g_cmd_upload.add_argument ('GROUP', help = 'repository group and optional repository name from INI file', metavar = 'GROUP[:REPO]')
-g_cmd_upload.add_argument ('SPEC', help = 'spec file (comma-separated if more than one)')
-g_cmd_upload.set_defaults (cmd = move_cmd)
 
 # Parse data for move command.
 
-g_cmd_move = g_cmds.add_parser ('move',
-  help = 'move build results to another repository in group', description = '''
+def add_move_cmd ():
+
+  cmd = g_cmds.add_parser ('move',
+    help = 'move build results to another repository in group', description = '''
 Moves all RPMs built from SPEC to a given repository of a configured repository group.
 The RPMs must already reside in a different repository of this group (as a result of `upload`
 or another `move`). If REPO is not specified, the next GROUP's repository is used as a target.
 VER must specify a version of the build to be moved.''',
-  formatter_class = g_cmdline.formatter_class)
+    formatter_class = g_cmdline.formatter_class)
+
+  cmd.add_argument ('GROUP', help = 'repository group and optional repository name from INI file', metavar = 'GROUP[:REPO]')
+  cmd.add_argument ('SPEC', help = 'spec name and version (comma-separated if more than one)', metavar = 'SPEC:VER')
+  cmd.set_defaults (cmd = move_cmd)
 
-g_cmd_move.add_argument ('GROUP', help = 'repository group and optional repository name from INI file', metavar = 'GROUP[:REPO]')
-g_cmd_move.add_argument ('SPEC', help = 'spec name and version (comma-separated if more than one)', metavar = 'SPEC:VER')
-g_cmd_move.set_defaults (cmd = move_cmd)
 
 # Parse data for remove command.
 
-g_cmd_remove = g_cmds.add_parser ('remove',
-  help = 'remove build results locally or from repository in group', description = '''
+def add_remove_cmd ():
+
+  cmd = g_cmds.add_parser ('remove',
+    help = 'remove build results locally or from repository in group', description = '''
 Removes all RPMs built from SPEC with `build` command or moved to a repository of a configured repository group
 with `upload` or `move` command.
 If GROUP is not specified, local results of `build` command will be removed and VER specification is ignored.
 Otherwise, SPEC's RPMs will be looked up in repositories of the given group and removed if found;
 VER must specify a version of the build to remove in this case.''',
-  formatter_class = g_cmdline.formatter_class)
+    formatter_class = g_cmdline.formatter_class)
+
+  cmd.add_argument ('GROUP', help = 'optional repository group name from INI file', metavar = 'GROUP', nargs = '?')
+  cmd.add_argument ('SPEC', help = 'spec name and version (comma-separated if more than one)', metavar = 'SPEC[:VER]')
+  cmd.set_defaults (cmd = move_cmd)
 
-g_cmd_remove.add_argument ('GROUP', help = 'optional repository group name from INI file', metavar = 'GROUP', nargs = '?')
-g_cmd_remove.add_argument ('SPEC', help = 'spec name and version (comma-separated if more than one)', metavar = 'SPEC[:VER]')
-g_cmd_remove.set_defaults (cmd = move_cmd)
 
 # Parse data for list command.
 
-g_cmd_list = g_cmds.add_parser ('list',
-  help = 'list build versions available in remote repositories', description = '''
+def add_list_cmd ():
+
+  cmd = g_cmds.add_parser ('list',
+    help = 'list build versions available in remote repositories', description = '''
 Lists all versions of RPMs built from SPEC in a given repository of a configured repository group.
 Wildcard characters *, ? and [] may be used for GROUP, REPO and SPEC to limit the output to specific
 repositories and packages. If no arguments are given, all build results from all repositories will be
 listed.''',
-  formatter_class = g_cmdline.formatter_class)
+    formatter_class = g_cmdline.formatter_class)
+
+  cmd.add_argument ('GROUP', help = 'repository group and optional repository name wildcards', metavar = 'GROUP[:REPO]', nargs = '?', default = '*')
+  cmd.add_argument ('SPEC', help = 'spec name wildcard (comma-separated if more than one)', metavar = 'SPEC', nargs = '?', default = '*')
+  cmd.set_defaults (cmd = list_cmd)
 
-g_cmd_list.add_argument ('GROUP', help = 'repository group and optional repository name wildcards', metavar = 'GROUP[:REPO]', nargs = '?', default = '*')
-g_cmd_list.add_argument ('SPEC', help = 'spec name wildcard (comma-separated if more than one)', metavar = 'SPEC', nargs = '?', default = '*')
-g_cmd_list.set_defaults (cmd = list_cmd)
 
 # Parse data for info command.
 
-g_cmd_info = g_cmds.add_parser ('info',
-  help = 'show build info from remote repository', description = '''
+def add_info_cmd ():
+
+  cmd = g_cmds.add_parser ('info',
+    help = 'show build info from remote repository', description = '''
 Shows information about RPMs built from SPEC in a given repository of a configured repository group.
 REPO must specify a GROUP's repository.
 VER must specify a version of the build to be shown.''',
-  formatter_class = g_cmdline.formatter_class)
+    formatter_class = g_cmdline.formatter_class)
+
+  cmd.add_argument ('GROUP', help = 'repository group and repository name from INI file', metavar = 'GROUP:REPO')
+  cmd.add_argument ('SPEC', help = 'spec name (comma-separated if more than one)', metavar = 'SPEC:VER')
+  cmd.set_defaults (cmd = info_cmd)
+
 
-g_cmd_info.add_argument ('GROUP', help = 'repository group and repository name from INI file', metavar = 'GROUP:REPO')
-g_cmd_info.add_argument ('SPEC', help = 'spec name (comma-separated if more than one)', metavar = 'SPEC:VER')
-g_cmd_info.set_defaults (cmd = info_cmd)
+# Note: only create the subparser of the command being run to save time (all of
+# them are needed only to show top-level help or report an unknown command).
+
+g_cmd_factories = {'test': add_test_cmd, 'build': add_build_cmd, 'upload': add_upload_cmd, 'move': add_move_cmd, 'remove': add_remove_cmd, 'list': add_list_cmd, 'info': add_info_cmd}
+
+g_cmd_name = next ((a for a in sys.argv [1:] if not a.startswith ('-')), None)
+for name, factory in g_cmd_factories.items ():
+  if g_cmd_name not in g_cmd_factories or name == g_cmd_name:
+    factory ()
 
 # Finally, do the parsing.
 
@@ -2009,11 +2561,7 @@ try:
 
   # Pre-evaluate some RPMBUILD macros (this will also chedk for RPMBUILD_EXE availability).
 
-  for i, m in enumerate (command_output ([
-    RPMBUILD_EXE, '--eval',
-    ''.join ('|%{?' + s + '}' for s in g_rpmbuild_used_macros).lstrip ('|')
-  ]).strip ().split ('|')):
-    g_rpm [g_rpmbuild_used_macros [i]] = m
+  eval_rpm_macros (g_rpmbuild_used_macros, g_rpm)
 
   for m in ['_topdir', '_sourcedir']:
     if not g_rpm [m] or not os.path.isdir (g_rpm [m]):
@@ -2023,8 +2571,10 @@ try:
 
   g_zip_dir = os.path.join (g_rpm ['_topdir'], 'zip')
   g_log_dir = os.path.join (g_rpm ['_topdir'], 'logs')
+  g_test_log_dir = os.path.join (g_log_dir, 'test')
+  g_build_log_dir = os.path.join (g_log_dir, 'build')
 
-  for d in [g_zip_dir] + [os.path.join (g_log_dir, f) for f in ('test', 'build')]:
+  for d in [g_zip_dir, g_test_log_dir, g_build_log_dir]:
     ensure_dir (d)
 
   # Create own log file unless redirected to a file.
@@ -2079,6 +2629,7 @@ except CommandCancelled:
 
 except:
 
+  import traceback
   log_err ('Unexpected exception occured:')
   log (traceback.format_exc ())
   rc = 127